@@ -9,8 +9,8 @@ from logging.handlers import RotatingFileHandler
 import paho.mqtt.client as mqtt
 import ssl
 import argparse
-import copy
 import json
+import re
 
 """
 Description
@@ -93,6 +93,13 @@ measurement = {}
 measurementshare = {}
 s0pcmreaderversion = '2024.05.06'
 
+# ------------------------------------------------------------------------------------
+# S0PCM data record, see the description above. The S0PCM-2 only has 'M1' and 'M2'.
+# The serialport is read with a short timeout, then we notice it when we need to stop.
+# ------------------------------------------------------------------------------------
+SERIALREADTIMEOUT = 1
+S0PCMPACKET = re.compile(r'^ID:(\d+):I:(\d+):M1:(\d+):(\d+):M2:(\d+):(\d+)(?::M3:(\d+):(\d+):M4:(\d+):(\d+):M5:(\d+):(\d+))?$')
+
 # ------------------------------------------------------------------------------------
 # Parameters
 # ------------------------------------------------------------------------------------
@@ -184,6 +191,7 @@ def ReadConfig():
     if not 'retain' in config['mqtt']: config['mqtt']['retain'] = True
     if not 'split_topic' in config['mqtt']: config['mqtt']['split_topic'] = True
     if not 'connect_retry' in config['mqtt']: config['mqtt']['connect_retry'] = 5
+    if not 'connect_retry_max' in config['mqtt']: config['mqtt']['connect_retry_max'] = 128
     if not 'online' in config['mqtt']: config['mqtt']['online'] = 'online'
     if not 'offline' in config['mqtt']: config['mqtt']['offline'] = 'offline'
     if not 'lastwill' in config['mqtt']: config['mqtt']['lastwill'] = 'offline'
@@ -232,11 +240,13 @@ def ReadConfig():
 
     logger.info(f'Start: s0pcm-reader - version: {s0pcmreaderversion}')
     
-    logger.debug('Config: %s', str(config))
+    logger.debug('Config: %s', config)
 
 # ------------------------------------------------------------------------------------
 # Read the 'measurement.yaml' file
 # ------------------------------------------------------------------------------------
+METERDEFAULTS = {'pulsecount': 0, 'total': 0, 'today': 0, 'yesterday': 0}
+
 def ReadMeasurement():
 
     global measurement
@@ -256,16 +266,44 @@ def ReadMeasurement():
                 measurement['date'] = datetime.datetime.strptime(str(measurement['date']), '%Y-%m-%d')
                 measurement['date'] = measurement['date'].date()
             except ValueError:
-                logger.error('\'%s\' has an invalid date field \'%s\', default to today \'%s\'', measurementname, str(measurement['date']), str(datetime.date.today()))
+                logger.error('\'%s\' has an invalid date field \'%s\', default to today \'%s\'', measurementname, measurement['date'], datetime.date.today())
                 measurement['date'] = datetime.date.today()
         else:
             measurement['date'] = datetime.date.today()
 
-        logger.debug('Measurement: %s', str(measurement))
+        # An input without any fields is read as 'None', the counters are initialized when the input is in a packet
+        for key in measurement:
+            if isinstance(key, int) and measurement[key] == None:
+                measurement[key] = {}
+
+        logger.debug('Measurement: %s', measurement)
     else:
-        logger.error('\'%s\' is empty: \'%s\' fix this by removing the file or restoring a backup if you have one...', measurementname, str(measurement))
+        logger.error('\'%s\' is empty: \'%s\' fix this by removing the file or restoring a backup if you have one...', measurementname, measurement)
         raise SystemExit('Cannot continue, the error above needs to be fixed first')
 
+# ------------------------------------------------------------------------------------
+# Make a light copy of the measurement data, only the inputs and the fields which are
+# used by MQTT are copied. This is a lot cheaper then a 'copy.deepcopy'. A snapshot is
+# never modified after it is shared, so the MQTT task can use it without copying.
+# When a previous snapshot is given, only the inputs in 'changed' are copied again and
+# the others are reused, then the MQTT task can skip them by comparing the identity.
+# ------------------------------------------------------------------------------------
+SNAPSHOTFIELDS = ('name', 'enabled', 'total', 'today', 'yesterday')
+PUBLISHFIELDS = ('total', 'today', 'yesterday')
+
+def SnapshotMeasurement(data, previous=None, changed=()):
+
+    snapshot = {}
+
+    for key, value in data.items():
+        if isinstance(key, int):
+            if previous != None and key not in changed and key in previous:
+                snapshot[key] = previous[key]
+            else:
+                snapshot[key] = {field: value[field] for field in SNAPSHOTFIELDS if field in value}
+
+    return snapshot
+
 # ------------------------------------------------------------------------------------
 # Task to read the serial port. We continue to try to open the serialport, because
 # we don't want to exit with such error.
@@ -279,166 +317,221 @@ class TaskReadSerial(threading.Thread):
 
         self._serialerror = 0
 
-    def ReadSerial(self):
+        # The inputs which are initialized, then we only need to check for missing counters once per input
+        self._knowninputs = set()
+
+        # The serialport settings, these don't change while running so we only bundle them once
+        self._serialport = config['serial']['port']
+        self._serialsettings = {'baudrate': config['serial']['baudrate'],
+                                'parity': config['serial']['parity'],
+                                'stopbits': config['serial']['stopbits'],
+                                'bytesize': config['serial']['bytesize'],
+                                'timeout': SERIALREADTIMEOUT}
+
+        # The daily statistics filename per input, these don't change while running
+        self._dailystat = {}
+        if config['s0pcm']['dailystat'] != None:
+            self._dailystat = {count: f'{configdirectory}daily-{count}.txt' for count in config['s0pcm']['dailystat']}
+
+    # Returns True when the counters of the input changed. The date change is determined once per packet
+    # by the caller, which also updates the date itself after all inputs are handled
+    def UpdateMeter(self, count, pulsecount, today, rollover):
+
+        changed = False
+
+        meter = measurement.get(count)
+
+        # Initialize the counters, if they doesn't exist. Only the first time the input is in a packet, the
+        # inputs which are not reported by the S0PCM are kept as they are in the 'measurement.yaml' file
+        if count not in self._knowninputs:
+            if meter == None:
+                meter = measurement[count] = {}
+            for field, value in METERDEFAULTS.items():
+                if field not in meter:
+                    meter[field] = value
+                    changed = True
+            self._knowninputs.add(count)
+
+        # We got a date change
+        if rollover:
+            logger.debug('Day changed from \'%s\' to \'%s\', resetting today counter \'%d\' to \'0\'. Yesterday counter is \'%d\'', measurement['date'], today, count, meter['today'])
+            meter['yesterday'] = meter['today']
+            meter['today'] = 0
+            changed = True
+
+            # Write the counters to a text file if required
+            dailystat = self._dailystat.get(count)
+            if dailystat != None:
+                try:
+                    fstat = open(dailystat, 'a')
+                    fstat.write(f"{measurement['date']};{meter['yesterday']}\n")
+                    fstat.close()
+                except Exception as e:
+                    logger.error('Stats file \'%s\' write/create failed. %s: \'%s\'', dailystat, type(e).__name__, e)
+
+        # Most of the time there are no new pulses, then there is nothing more to do
+        previous = meter['pulsecount']
+        if pulsecount == previous:
+            return changed
+
+        if pulsecount > previous:
+
+            logger.debug('Pulsecount changed from \'%d\' to \'%d\'', previous, pulsecount)
+
+            # Pulsecount has changed, lets do some magic :-)
+            delta = pulsecount - previous
+        else:
+            logger.warning('Stored pulsecount \'M%d\' is higher then read, this normally happens if the s0pcm is restarted. We will continue counting, but for an precise value, read the meter value and correct the totals in the \'%s\' file', count, measurementname)
+            delta = pulsecount
+
+        meter['pulsecount'] = pulsecount
+        meter['total'] += delta
+        meter['today'] += delta
+
+        return True
+
+    # Returns True when a data packet was handled, the changed inputs are added to 'changed'. The caller
+    # writes the file and triggers the MQTT task, then this is done once for all packets read at once.
+    def HandleLine(self, datain, changed):
+
+        # Need to remove '\r\n' from the input, we do this before decoding then only one string is created
+        datain = datain.rstrip(b'\r\n')
+
+        # The type of packet is determined on the raw data, then we only decode the data when it is used.
+        # The data packets are the most common, so check these first
+        if datain.startswith(b'ID:'):
+
+            # need to decode the data to ascii string
+            try:
+                datastr = datain.decode('ascii')
+            except UnicodeDecodeError:
+                logger.error('Failed to decode \'%s\'', datain)
+                return
+
+            logger.debug('S0PCM Packet: \'%s\'', datastr)
+
+            # Parse the packet, this also validates the 'M1' till 'M5' markers and the pulsecounts
+            match = S0PCMPACKET.match(datastr)
+
+            if match == None:
+                logger.error('Packet has invalid format. Expected a S0PCM-2 or S0PCM-5 packet, got \'%s\'.', datastr)
+                return
+
+            # Only get the date once per packet, the 'date' in the measurement is also a date object
+            today = datetime.date.today()
+
+            # A date change applies to all inputs of the packet
+            rollover = measurement['date'] != today
+
+            # Loop through 2/5 s0pcm data, we are interested in the total pulse count, because that is most reliable
+            # The S0PCM-2 doesn't have 'M3' till 'M5', so these are 'None'
+            for count, pulsecount in enumerate(match.groups()[3::2], 1):
+                if pulsecount != None:
+                    if self.UpdateMeter(count, int(pulsecount), today, rollover):
+                        changed.add(count)
+
+            # Update todays date - but we don't convert to str yet, it looks nicer without it in the yaml file ;-)
+            # A date change also changes all inputs, so the file is written
+            if rollover:
+                measurement['date'] = today
+
+            return True
+
+        elif datain.startswith(b'/'):
+            logger.debug('Header Packet: \'%s\'', datain.decode('ascii', 'replace'))
+        elif datain == b'':
+            logger.warning('Empty Packet received, this can happen during start-up')
+        else:
+            logger.error('Invalid Packet: \'%s\'', datain.decode('ascii', 'replace'))
+
+    # Write the 'measurement.yaml' file and share the new data with the MQTT task. Only when data has changed.
+    def SaveMeasurement(self, changed):
 
         global measurementshare
 
+        if not changed:
+            logger.debug('No change to the \'%s\' file (no write)', measurementname)
+            return
+
+        logger.debug('Updated \'%s\' file', measurementname)
+        with open(measurementname, 'w') as f:
+            yaml.dump(measurement, f, default_flow_style=False)
+
+        # Do some lock/release on global variables, we replace the shared snapshot instead of modifying it.
+        # Only this thread replaces the snapshot, so reading the current one and building the new one
+        # doesn't need the lock, only the replace does.
+        # When nothing changed we keep the current snapshot, then the MQTT task knows there is no delta.
+        snapshot = SnapshotMeasurement(measurement, measurementshare, changed)
+        with lock:
+            measurementshare = snapshot
+
+    def ReadSerial(self):
+
+        # Bind the serial settings to locals, these don't change while running
+        connectretry = config['serial']['connect_retry']
+        timeout = config['serial']['timeout']
+
         while not self._stopper.is_set():
 
-            logger.debug('Opening serialport \'%s\'', config['serial']['port'])
+            logger.debug('Opening serialport \'%s\'', self._serialport)
 
             try:
-                ser = serial.Serial(config['serial']['port'], 
-                                    baudrate=config['serial']['baudrate'],
-                                    parity=config['serial']['parity'],
-                                    stopbits=config['serial']['stopbits'],
-                                    bytesize=config['serial']['bytesize'],
-                                    timeout=config['serial']['timeout'])
+                ser = serial.Serial(self._serialport, **self._serialsettings)
                 self._serialerror = 0
             except Exception as e:
                 self._serialerror += 1
-                logger.error('Serialport connection failed. %s: \'%s\'', type(e).__name__, str(e))
-                logger.error('Retry in %d seconds', config['serial']['connect_retry'])
-                time.sleep(config['serial']['connect_retry'])
+                logger.error('Serialport connection failed. %s: \'%s\'', type(e).__name__, e)
+                logger.error('Retry in %d seconds', connectretry)
+
+                # Wait on the stopper instead of a sleep, then we stop directly when requested
+                self._stopper.wait(connectretry)
                 continue
 
             # Only do a read of the data when the port is opened succesfully
+            buffer = bytearray()
+            lastdata = time.monotonic()
+
             while not self._stopper.is_set():
 
+                # Read everything which is waiting at once, 'readline' reads byte by byte
                 try:
-                    datain = ser.readline()
+                    datain = ser.read(ser.in_waiting or 1)
                 except Exception as e:
-                    logger.error('Serialport read error. %s: \'%s\'', type(e).__name__, str(e))
+                    logger.error('Serialport read error. %s: \'%s\'', type(e).__name__, e)
                     ser.close()
                     break
-             
+
                 # check if there is data received
-                # If there is really nothing, most likely a timeout on reading the input data
+                # A read timeout only means there is no data yet, only when there is nothing for the configured timeout
+                # we reopen the serialport
                 if len(datain) == 0:
-                    logger.error('Failed to read any data (timeout)')
-                    ser.close()
-                    break
-
-                # need to decode the data to ascii string
-                try:
-                    datastr = datain.decode('ascii')
-                except UnicodeDecodeError:
-                    logger.error('Failed to decode \'%s\'', str(datain))
+                    if timeout != None and time.monotonic() - lastdata >= timeout:
+                        logger.error('Failed to read any data (timeout)')
+                        ser.close()
+                        break
                     continue
 
-                # Need to remove '\r\n' from the input
-                datastr = datastr.rstrip('\r\n')
-
-                if datastr.startswith('/'):
-                    logger.debug('Header Packet: \'%s\'', datastr)
-                elif datastr.startswith('ID:'):
-                    logger.debug('S0PCM Packet: \'%s\'', datastr)
-
-                    # Split data into an array
-                    s0arr = datastr.split(':')
-
-                    # s0pcm-5 - 19
-                    if len(s0arr) == 19:
-                        # ID:8237:I:10:M1:0:0:M2:0:0:M3:0:0:M4:0:0:M5:0:0
-                        size = 5
-
-                    # s0pcm-2 - 10
-                    elif len(s0arr) == 10: 
-                        # ID:8237:I:10:M1:0:0:M2:0:0
-                        size = 2
-
-                    else:
-                        logger.error('Packet has invalid length. Excepted 10 or 19, got %d.', len(s0arr))
-                        continue
-
-                    # Key a copy of the measurement file, then we known we need to write the file
-                    measurementstr = str(measurement)
-
-                    # Loop through 2/5 s0pcm data
-                    for count in range(1, size + 1):
-                        offset = 4 + ((count - 1) * 3)
-                        if s0arr[offset] == 'M' + str(count):
-                            # We are interested in the total pulse count, because that is most reliable
-
-                            try:
-                                pulsecount = int(s0arr[offset + 2])
-                            except:
-                                logger.error('Cannot convert pulsecount \'%s\' into integer, received \'%s\'', s0arr[offset], s0arr[offset + 2])
-                                pulsecount = 0
-
-                            # Initialize the variables, if they doesn't exist
-                            if not count in measurement: measurement[count] = {}
-                            if not 'pulsecount' in measurement[count]: measurement[count]['pulsecount'] = 0
-                            if not 'total' in measurement[count]: measurement[count]['total'] = 0
-                            if not 'today' in measurement[count]: measurement[count]['today'] = 0
-                            if not 'yesterday' in measurement[count]: measurement[count]['yesterday'] = 0
-                            
-                            # We got a date change
-                            if str(measurement['date']) != str(datetime.date.today()):
-                                logger.debug('Day changed from \'%s\' to \'%s\', resetting today counter \'%d\' to \'0\'. Yesterday counter is \'%d\'', str(measurement['date']), str(datetime.date.today()), count, measurement[count]['today'])
-                                measurement[count]['yesterday'] = measurement[count]['today']
-                                measurement[count]['today'] = 0
-
-                                # Write the counters to a text file if required
-                                todayfile = False
-                                if config['s0pcm']['dailystat'] != None:
-                                    if count in config['s0pcm']['dailystat']:
-                                        todayfile = True
-
-                                if todayfile == True:
-                                    try:
-                                        fstat = open(configdirectory + 'daily-' + str(count) + '.txt', 'a')
-                                        fstat.write(str(measurement['date']) + ';' + str(measurement[count]['yesterday']) + '\n')
-                                        fstat.close()
-                                    except Exception as e:
-                                        logger.error('Stats file \'%s\' write/create failed. %s: \'%s\'', configdirectory + 'daily-' + str(count) + '.txt', type(e).__name__, str(e))
-                            
-                            if pulsecount > measurement[count]['pulsecount']:
-
-                                logger.debug('Pulsecount changed from \'%d\' to \'%d\'', measurement[count]['pulsecount'], pulsecount)
-
-                                # Pulsecount has changed, lets do some magic :-)
-                                delta = pulsecount - measurement[count]['pulsecount']
-                                measurement[count]['pulsecount'] = pulsecount
-                                measurement[count]['total'] += delta
-                                measurement[count]['today'] += delta
-
-                            elif pulsecount < measurement[count]['pulsecount']:
-                                logger.warning('Stored pulsecount \'%s\' is higher then read, this normally happens if the s0pcm is restarted. We will continue counting, but for an precise value, read the meter value and correct the totals in the \'%s\' file', s0arr[offset], measurementname)
-                                delta = pulsecount
-                                measurement[count]['pulsecount'] = pulsecount
-                                measurement[count]['total'] += delta
-                                measurement[count]['today'] += delta
-
-                        else:
-                            logger.error('Expecting \'M%s\', received \'%s\'', str(count), s0arr[offset])
-                            continue
-
-                    # Update todays date - but we don't convert to str yet, it looks nicer without it in the yaml file ;-)
-                    if str(measurement['date']) != str(datetime.date.today()):
-                        measurement['date'] = datetime.date.today()
-
-                    # Write the 'measurement.yaml' file with the new data. Only when data has changed.
-                    if measurementstr == str(measurement):
-                        logger.debug('No change to the \'%s\' file (no write)', measurementname)
-                    else:
-                        logger.debug('Updated \'%s\' file', measurementname)
-                        with open(measurementname, 'w') as f:
-                            yaml.dump(measurement, f, default_flow_style=False)
-
-                    # Do some lock/release on global variables
-                    lock.acquire()
-                    measurementshare = copy.deepcopy(measurement)
-                    lock.release()
-
-                    # Trigger that new data is available for MQTT
+                lastdata = time.monotonic()
+                buffer += datain
+
+                # Handle all complete lines in the buffer, a partial line stays in the buffer
+                # Keep track of the changed inputs, then we known we need to write the file and which inputs to copy
+                newdata = False
+                changed = set()
+                while True:
+                    end = buffer.find(b'\n')
+                    if end == -1:
+                        break
+
+                    if self.HandleLine(bytes(buffer[:end + 1]), changed):
+                        newdata = True
+                    del buffer[:end + 1]
+
+                # Write the file and trigger that new data is available for MQTT, only once when multiple packets were read at once
+                if newdata:
+                    self.SaveMeasurement(changed)
                     self._trigger.set()
 
-                elif datastr == '':
-                    logger.warning('Empty Packet received, this can happen during start-up')
-                else:
-                    logger.error('Invalid Packet: \'%s\'', datastr)
-
     def run(self):
         try:
             self.ReadSerial()
@@ -458,16 +551,58 @@ class TaskDoMQTT(threading.Thread):
         self._trigger = trigger
         self._stopper = stopper
         self._connected = False
+        self._connack = threading.Event()
+        self._active = {}
+        self._topics = {}
+        self._statustopic = f"{config['mqtt']['base_topic']}/status"
+
+    # The enabled flag and the include list don't change while running, so we only
+    # need to determine once per input if it should be published
+    def IsActive(self, key, data):
+
+        active = self._active.get(key)
+
+        if active == None:
+            active = True
+
+            if not data.get('enabled', True):
+                active = False
+            elif config['s0pcm']['include'] != None and not key in config['s0pcm']['include']:
+                logger.debug('MQTT Publish for input \'%d\' is disabled', key)
+                active = False
+
+            self._active[key] = active
+
+        return active
+
+    # The topics of an input don't change while running, so we only build them once per
+    # input instead of on every publish
+    def GetTopics(self, key, data):
+
+        topics = self._topics.get(key)
+
+        if topics == None:
+            topic = f"{config['mqtt']['base_topic']}/{data.get('name', key)}"
+            topics = (topic, {subkey: f'{topic}/{subkey}' for subkey in PUBLISHFIELDS})
+            self._topics[key] = topics
+
+        return topics
 
     def on_connect(self, mqttc, obj, flags, reason_code, properties):
         if reason_code == 0:
             self._connected = True
             logger.debug('MQTT successfully connected to broker')
-            self._mqttc.publish(config['mqtt']['base_topic'] + '/status', config['mqtt']['online'], retain=config['mqtt']['retain'])
+            self._mqttc.publish(self._statustopic, config['mqtt']['online'], retain=config['mqtt']['retain'])
         else:
             self._connected = False
             logger.error('MQTT failed to connect to broker \'%s\', retrying.', mqtt.connack_string(reason_code))
 
+        # Let the MQTT task know the broker answered the connect
+        self._connack.set()
+
+    def on_connect_fail(self, mqttc, obj):
+        logger.error('MQTT failed to connect to broker \'%s:%s\', retrying.', config['mqtt']['host'], config['mqtt']['port'])
+
     def on_disconnect(self, mqttc, obj, flags, reason_code, properties):
         self._connected = False
         if reason_code == 0:
@@ -476,29 +611,32 @@ class TaskDoMQTT(threading.Thread):
             logger.error('MQTT failed to disconnect from broker \'%s\', retrying.', mqtt.connack_string(reason_code))
 
     def on_message(self, mqttc, obj, msg):
-        logger.debug('MQTT on_message: ' + msg.topic + ' ' + str(msg.qos) + ' ' + str(msg.payload))
+        logger.debug('MQTT on_message: %s %s %s', msg.topic, msg.qos, msg.payload)
 
     def on_publish(self, mqttc, obj, mid, reason_codes, properties):
-        logger.debug('MQTT on_publish: mid: ' + str(mid))
+        logger.debug('MQTT on_publish: mid: %s', mid)
 
     def on_subscribe(self, mqttc, obj, mid, granted_qos):
-        logger.debug('MQTT on_subscribe: ' + str(mid) + ' ' + str(granted_qos))
+        logger.debug('MQTT on_subscribe: %s %s', mid, granted_qos)
 
     def on_log(self, mqttc, obj, level, string):
-        logger.debug('MQTT on_log: ' + string)
+        logger.debug('MQTT on_log: %s', string)
 
     def DoMQTT(self):
 
         global measurementshare
         measurementprevious = {}
 
-        # Copy the measurements to previous one, preventing send values when on change is enabled
-        measurementprevious = measurement
+        # Start with the shared snapshot as previous one, preventing send values when on change is enabled.
+        # The serial task is already running, so we may not read the measurements directly
+        with lock:
+            measurementprevious = measurementshare
 
         # Define our MQTT Client
         self._mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=config['mqtt']['client_id'], protocol=config['mqtt']['version'])
         self._mqttc.on_connect = self.on_connect
         self._mqttc.on_disconnect = self.on_disconnect
+        self._mqttc.on_connect_fail = self.on_connect_fail
         #self._mqttc.on_message = self.on_message
         #self._mqttc.on_publish = self.on_publish
         #self._mqttc.on_subscribe = self.on_subscribe
@@ -523,120 +661,126 @@ class TaskDoMQTT(threading.Thread):
             self._mqttc.tls_set_context(context=context)
 
         # Set last will
-        self._mqttc.will_set(config['mqtt']['base_topic'] + '/status', config['mqtt']['lastwill'], retain=config['mqtt']['retain'])
+        self._mqttc.will_set(self._statustopic, config['mqtt']['lastwill'], retain=config['mqtt']['retain'])
+
+        # Bind the settings used while publishing to locals, these don't change while running
+        retain = config['mqtt']['retain']
+        splittopic = config['mqtt']['split_topic']
+        publishinterval = config['s0pcm']['publish_interval']
+        publishonchange = config['s0pcm']['publish_onchange']
+        publish = self._mqttc.publish
+
+        # Let paho connect and reconnect in its own thread. The retry delay starts at 'connect_retry' and is
+        # doubled after every failed connect up to 'connect_retry_max', it is reset after a successful connect
+        self._mqttc.reconnect_delay_set(min_delay=config['mqtt']['connect_retry'], max_delay=config['mqtt']['connect_retry_max'])
+
+        logger.debug('Connecting to MQTT Broker \'%s:%s\'', config['mqtt']['host'], config['mqtt']['port'])
+
+        self._mqttc.connect_async(config['mqtt']['host'], int(config['mqtt']['port']), 60)
+        self._mqttc.loop_start()
+
+        # Wait until the broker answered the connect (max 10 seconds), otherwise we can be too fast
+        self._connack.wait(10)
 
         while not self._stopper.is_set():
+            #Do our publish here with information we get from other Thread
 
-            logger.debug('Connecting to MQTT Broker \'%s:%s\'', config['mqtt']['host'], str(config['mqtt']['port']))
+            # If no interval is defined, we wait on an event from the other thread
+            # We need to clear it (directly), otherwise it will run at  100% cpu
+            # The wait has a timeout, otherwise we never notice the stopper when the other thread stopped
+            if publishinterval == None:
+                if not self._trigger.wait(1):
+                    continue
+                self._trigger.clear()
 
-            try:
-                self._mqttc.connect(config['mqtt']['host'], int(config['mqtt']['port']), 60)
-            except Exception as e:
-                logger.error('MQTT connection failed. %s: \'%s\'', type(e).__name__, str(e))
-                logger.error('Retry in %d seconds', config['mqtt']['connect_retry'])
-                time.sleep(config['mqtt']['connect_retry'])
+            # Do some lock/release on global variables, the shared snapshot is never modified so no copy is needed
+            with lock:
+                measurementlocal = measurementshare
+
+            # Check if we are connected
+            if self._connected == False:
+                logger.debug('Not connected to MQTT Broker')
+                if publishinterval != None:
+                    time.sleep(publishinterval)
                 continue
 
-            #connect_async(host, port=1883, keepalive=60, bind_address="")
-            self._mqttc.loop_start()
+            # The serial task replaces the snapshot when there is new data, when we still have the same snapshot nothing changed
+            if measurementlocal is measurementprevious and publishonchange == True:
+                if publishinterval != None:
+                    time.sleep(publishinterval)
+                continue
 
-            # Let's wait 1 second, otherwise we can be too fast?
-            time.sleep(1)
+            # The snapshot only contains the inputs, so every key is an input
+            for key, data in measurementlocal.items():
 
-            while not self._stopper.is_set():
-                #Do our publish here with information we get from other Thread
-
-                # If no interval is defined, we wait on an event from the other thread
-                # We need to clear it (directly), otherwise it will run at  100% cpu
-                if config['s0pcm']['publish_interval'] == None:
-                    self._trigger.wait()
-                    self._trigger.clear()
-
-                # Do some lock/release on global variables
-                lock.acquire()
-                measurementlocal = copy.deepcopy(measurementshare)
-                lock.release()
-
-                # Check if we are connected
-                if self._connected == False:
-                    logger.debug('Not connected to MQTT Broker')
-                    if config['s0pcm']['publish_interval'] != None:
-                        time.sleep(config['s0pcm']['publish_interval'])
-                    continue
+                # define dict for json value
+                jsondata = {}
 
-                for key in measurementlocal:
-                    if isinstance(key, int):
+                # Skip an input if disabled or not configured
+                if not self.IsActive(key, data):
+                    continue
 
-                        # define dict for json value
-                        jsondata = {}
+                topic, subtopics = self.GetTopics(key, data)
 
-                        try:
-                            if not measurement[key]['enabled']:
-                                continue
-                        except:
-                            pass
+                # If there is no previous value, it should always be different
+                previous = measurementprevious.get(key)
 
-                        # Skip an input if not configured
-                        if config['s0pcm']['include'] != None:
-                            if not key in config['s0pcm']['include']:
-                                logger.debug('MQTT Publish for input \'%d\' is disabled', key)
-                                continue
+                # The serial task reuses the snapshot of an input which didn't change
+                if data is previous and publishonchange == True:
+                    continue
 
-                        try:
-                            instancename = measurementlocal[key]['name']
-                        except:
-                            instancename = str(key)
+                for subkey in PUBLISHFIELDS:
 
-                        for subkey in ['total', 'today', 'yesterday']:
+                    value = data.get(subkey)
+                    if value == None:
+                        continue
 
-                            # Try to assign the previous value, if this fails, we set it "-1" then it should always be different
-                            try:
-                                value_previous = measurementprevious[key][subkey]
-                            except:
-                                value_previous = -1
+                    try:
+                        if splittopic == True:
+                            # Check if the value not changed and publish on change is off
+                            if publishonchange == True and previous != None and value == previous.get(subkey):
+                                continue
 
-                            try:
-                                if subkey in measurementlocal[key]:
+                            logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'', subtopics[subkey], value)
 
-                                    if config['mqtt']['split_topic'] == True:
-                                        # Check if the value not changed and publish on change is off
-                                        if measurementlocal[key][subkey] == value_previous and config['s0pcm']['publish_onchange'] == True:
-                                            continue
+                            # Do a MQTT Publish
+                            publish(subtopics[subkey], value, retain=retain)
+                        else:
+                            jsondata[subkey] = value
 
-                                        logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'',config['mqtt']['base_topic'] + '/' + instancename + '/' + subkey, str(measurementlocal[key][subkey]))
+                    except Exception as e:
+                        logger.error('MQTT Publish Failed. Key=%s, SubKey=%s. %s: \'%s\'', key, subkey, type(e).__name__, e)
 
-                                        # Do a MQTT Publish
-                                        self._mqttc.publish(config['mqtt']['base_topic'] + '/' + instancename + '/' + subkey, measurementlocal[key][subkey], retain=config['mqtt']['retain'])
-                                    else:
-                                        jsondata[subkey] = measurementlocal[key][subkey]
+                # We should publish the json value
+                if splittopic == False:
+                    # Check if the values not changed and publish on change is on, then we can skip the json encoding too
+                    if publishonchange == True and previous != None and all(previous.get(subkey) == value for subkey, value in jsondata.items()):
+                        continue
 
-                            except Exception as e:
-                                logger.error('MQTT Publish Failed. Key=%s, SubKey=%s. %s: \'%s\'', str(key), subkey, type(e).__name__, str(e))
+                    try:
+                        payload = json.dumps(jsondata)
 
-                        # We should publish the json value
-                        if config['mqtt']['split_topic'] == False:
-                            try:
-                                logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'',config['mqtt']['base_topic'] + '/' + instancename, json.dumps(jsondata))
+                        logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'', topic, payload)
 
-                                # Do a MQTT Publish
-                                self._mqttc.publish(config['mqtt']['base_topic'] + '/' + instancename, json.dumps(jsondata), retain=config['mqtt']['retain'])
-                            except Exception as e:
-                                logger.error('MQTT Publish Failed. %s: \'%s\'', type(e).__name__, str(e))
+                        # Do a MQTT Publish
+                        publish(topic, payload, retain=retain)
+                    except Exception as e:
+                        logger.error('MQTT Publish Failed. %s: \'%s\'', type(e).__name__, e)
 
-                # Lets make also a copy of this one, then we can compare if there is a delta
-                measurementprevious = copy.deepcopy(measurementlocal)
+            # Keep this one, then we can compare if there is a delta. It is a snapshot which is never modified, so no copy is needed
+            measurementprevious = measurementlocal
 
-                # Now sleep according to publish interval
-                if config['s0pcm']['publish_interval'] != None:
-                    time.sleep(config['s0pcm']['publish_interval'])
+            # Now sleep according to publish interval
+            if publishinterval != None:
+                time.sleep(publishinterval)
 
-            self._mqttc.loop_stop()
+        self._mqttc.loop_stop()
 
-            # Send an official offline message
-            if self._connected:
-                self._mqttc.publish(config['mqtt']['base_topic'] + '/status', config['mqtt']['offline'], retain=config['mqtt']['retain'])
+        # Send an official offline message
+        if self._connected:
+            self._mqttc.publish(self._statustopic, config['mqtt']['offline'], retain=config['mqtt']['retain'])
 
-            self._mqttc.disconnect()
+        self._mqttc.disconnect()
 
     def run(self):
         try:
@@ -653,6 +797,9 @@ class TaskDoMQTT(threading.Thread):
 try:
     ReadConfig()
     ReadMeasurement()
+
+    # The serial task only replaces the shared snapshot when something changed, so start with the stored measurements
+    measurementshare = SnapshotMeasurement(measurement)
 except:
     logger.error('Fatal exception has occured', exc_info=True)
     # we need to quit, because we detected an error